@@ -1,13 +1,16 @@
 import os
 import asyncio
 import aiohttp
-from typing import Optional
+from contextlib import closing
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
 import sys
+from bs4 import BeautifulSoup
 from datetime import datetime
 
 # Import our scrapers
-from sitefox_text.scraper import WebsiteScraper
-from sitefox_images.scraper import WordPressImageScraper
+from sitefox_common.web import HTTPCache, RateLimiter, extract_links, fetch_html, normalize_url
+from sitefox_text.scraper import WebsiteScraper, extract_content
+from sitefox_images.scraper import WordPressImageScraper, extract_image_urls
 
 WELCOME_MESSAGE = """
 ╔══════════════════════════════════════════════════════════════╗
@@ -31,6 +34,97 @@ Please choose what you'd like to do:
 
 Enter your choice (1-3): """
 
+# Headers sent with every request made through the shared session.
+# Accept-Encoding is left to aiohttp, which already asks for gzip and deflate
+# (plus br when Brotli is installed) and decompresses the responses itself.
+COMMON_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+}
+
+# Maximum number of requests in flight per scraper
+MAX_CONCURRENT = 5
+
+# Request budget shared by all scrapers
+REQUESTS_PER_SECOND = 2.0
+
+# How many links deep to follow from the landing page
+MAX_CRAWL_DEPTH = 3
+
+def _parse_page(content: str, url: str, want_content: bool,
+                want_images: bool) -> Tuple[List[str], Optional[Tuple[str, List[Dict]]], Optional[List[str]]]:
+    """Parse a page once and extract its links, text content and images."""
+    soup = BeautifulSoup(content, "lxml")
+    links = extract_links(soup, url)
+    page = extract_content(soup, url) if want_content else None
+    image_urls = extract_image_urls(soup, url) if want_images else None
+    return links, page, image_urls
+
+async def crawl(session: aiohttp.ClientSession, seed: str, max_depth: int,
+                get_pages: Callable[[aiohttp.ClientSession, str], Awaitable[Set[str]]],
+                errors: List[str], max_concurrent: int = MAX_CONCURRENT) -> Set[str]:
+    """Breadth-first crawl from seed up to max_depth hops away, recording failed visits in errors."""
+    visited: Set[str] = {seed}
+    queue: asyncio.Queue = asyncio.Queue()
+    queue.put_nowait((seed, 0))
+
+    async def worker():
+        while True:
+            url, depth = await queue.get()
+            try:
+                links = await get_pages(session, url)
+                # Pages at the depth limit are visited but not expanded
+                if depth < max_depth:
+                    for link in links:
+                        if link not in visited:
+                            visited.add(link)
+                            queue.put_nowait((link, depth + 1))
+            except Exception as e:
+                # Keep the worker alive; with every worker gone, queue.join() never returns
+                errors.append(f"Error crawling {url}: {e}")
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(max_concurrent)]
+    await queue.join()
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    return visited
+
+async def bounded_map(coro_fn: Callable[[Any], Awaitable[Any]], items: Iterable[Any],
+                      limit: int = MAX_CONCURRENT) -> AsyncIterator[Tuple[Any, Any]]:
+    """Run coro_fn over items with at most limit in flight, yielding (item, result) as each completes."""
+    pending: asyncio.Queue = asyncio.Queue()
+    for item in items:
+        pending.put_nowait(item)
+    total = pending.qsize()
+    done: asyncio.Queue = asyncio.Queue()
+
+    async def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                result = await coro_fn(item)
+            except Exception as e:
+                await done.put((item, None, e))
+            else:
+                await done.put((item, result, None))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(limit, total))]
+    try:
+        for _ in range(total):
+            item, result, error = await done.get()
+            if error is not None:
+                raise error
+            yield item, result
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
 async def process_domain(domain: str, choice: int) -> None:
     """Process the domain according to user's choice."""
     # Clean up domain input - handle https:// properly
@@ -56,89 +150,118 @@ async def process_domain(domain: str, choice: int) -> None:
 
     print(f"\nProcessing {domain}...")
     
-    text_scraper: Optional[WebsiteScraper] = None
-    image_scraper: Optional[WordPressImageScraper] = None
+    # One limiter for both scrapers so their combined traffic respects a single budget
+    rate_limiter = RateLimiter(REQUESTS_PER_SECOND)
+    # Validators from earlier runs, so unchanged pages and files aren't downloaded again
+    with closing(HTTPCache(os.path.join(downloads_dir, ".cache.db"))) as http_cache:
+        text_scraper: Optional[WebsiteScraper] = None
+        image_scraper: Optional[WordPressImageScraper] = None
 
-    if choice in [1, 3]:
-        print("\n[Text Scraper]")
-        text_scraper = WebsiteScraper(domain)
+        if choice in [1, 3]:
+            print("\n[Text Scraper]")
+            text_scraper = WebsiteScraper(domain, max_concurrent=MAX_CONCURRENT, rate_limiter=rate_limiter,
+                                          http_cache=http_cache)
         
-    if choice in [2, 3]:
-        print("\n[Image Scraper]")
-        image_scraper = WordPressImageScraper(domain)
-
-    # Create shared session for all operations
-    async with aiohttp.ClientSession() as session:
-        # Process text content if selected
-        if text_scraper:
+        if choice in [2, 3]:
+            print("\n[Image Scraper]")
+            image_scraper = WordPressImageScraper(domain, max_concurrent=MAX_CONCURRENT,
+                                                  rate_limiter=rate_limiter, http_cache=http_cache)
+
+        # Create shared session for all operations. The connector keeps connections
+        # alive and caches DNS lookups so repeated requests to the same host skip
+        # the TCP/TLS handshake.
+        connector = aiohttp.TCPConnector(
+            limit=MAX_CONCURRENT * 2,
+            limit_per_host=MAX_CONCURRENT,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+        )
+        async with aiohttp.ClientSession(connector=connector, headers=COMMON_HEADERS) as session:
+            # Crawl the site once, extracting text and images while each page is
+            # parsed so neither stage has to fetch it again. The text scraper
+            # filters links when present since it also collects PDF links.
             print("Scanning for pages...")
-            pages = await text_scraper.get_linked_pages(session, text_scraper.base_url)
-            pages.add(text_scraper.base_url)
-            print(f"Found {len(pages)} pages to process.")
-
-            tasks = []
-            for page_url in pages:
-                tasks.append(text_scraper.scrape_page_content(session, page_url))
-
-            for i in range(0, len(tasks), text_scraper.max_concurrent):
-                chunk = tasks[i:i + text_scraper.max_concurrent]
-                results = await asyncio.gather(*chunk)
-                
-                for page_url, (title, elements) in zip(list(pages)[i:i + text_scraper.max_concurrent], results):
-                    if elements:
-                        text_scraper.pages_data[page_url] = {
-                            "title": title,
-                            "elements": elements
-                        }
-                        print(f"Scraped text: {page_url}")
-
-            print("\nGenerating text files...")
-            await text_scraper.save_files()
-
-        # Process images if selected
-        if image_scraper:
-            print("\nScanning for images...")
-            pages = await image_scraper.get_linked_pages(session, image_scraper.base_url)
-            pages.add(image_scraper.base_url)
-            print(f"Found {len(pages)} pages to check for images.")
-
-            tasks = []
-            for page_url in pages:
-                tasks.append(image_scraper.find_images_on_page(session, page_url))
-
-            for i in range(0, len(tasks), image_scraper.max_concurrent):
-                chunk = tasks[i:i + image_scraper.max_concurrent]
-                await asyncio.gather(*chunk)
-
-            # Download found images
-            print("\nDownloading images...")
-            for page_name, image_urls in image_scraper.images.items():
-                if not image_urls:
-                    continue
-                    
-                tasks = []
-                for img_url in image_urls:
-                    tasks.append(image_scraper.download_image(session, img_url, page_name))
-
-                for i in range(0, len(tasks), image_scraper.max_concurrent):
-                    chunk = tasks[i:i + image_scraper.max_concurrent]
-                    await asyncio.gather(*chunk)
+            link_scraper = text_scraper or image_scraper
+            scraped: Dict[str, Dict] = {}
+
+            async def visit_page(session: aiohttp.ClientSession, url: str) -> Set[str]:
+                try:
+                    content = await fetch_html(session, url, rate_limiter, link_scraper.headers, http_cache)
+                    # Parse in a worker thread so the event loop keeps other requests moving
+                    links, page, image_urls = await asyncio.to_thread(
+                        _parse_page, content, url, text_scraper is not None, image_scraper is not None)
+
+                    if text_scraper:
+                        title, elements = page
+                        if elements:
+                            scraped[url] = {
+                                "title": title,
+                                "elements": elements
+                            }
+                            print(f"Scraped text: {url}")
+                    if image_scraper:
+                        image_scraper.add_page_images(url, image_urls)
+                    return link_scraper.filter_links(links)
+                except Exception as e:
+                    for scraper in (text_scraper, image_scraper):
+                        if scraper:
+                            scraper.errors.append(f"Error fetching {url}: {e}")
+                    return set()
+
+            # Start from the given URL itself so a path such as example.com/blog is kept
+            seed = normalize_url(link_scraper.base_url)
+            pages = await crawl(session, seed, MAX_CRAWL_DEPTH,
+                                visit_page, link_scraper.errors, link_scraper.max_concurrent)
+            print(f"Found {len(pages)} pages.")
+
+            # Process text content if selected
+            if text_scraper:
+                # Keep pages in URL order so the TOC and Markdown are the same on every run
+                for page_url in sorted(scraped):
+                    text_scraper.pages_data[page_url] = scraped[page_url]
+
+                # Download PDFs linked from the crawled pages. Sorted so PDFs that
+                # share a filename are given the same names on every run.
+                if text_scraper.pdf_urls:
+                    print("\nDownloading PDFs...")
+                    async for _ in bounded_map(lambda url: text_scraper.download_pdf(session, url),
+                                               sorted(text_scraper.pdf_urls), text_scraper.max_concurrent):
+                        pass
+
+                print("\nGenerating text files...")
+                await text_scraper.save_files()
+
+            # Process images if selected
+            if image_scraper:
+                # Download found images across all pages through one worker pool,
+                # in a stable order so clashing filenames resolve the same way each run
+                print("\nDownloading images...")
+                downloads = sorted((img_url, page_name)
+                                   for page_name, image_urls in image_scraper.images.items()
+                                   for img_url in image_urls)
+                async for _ in bounded_map(lambda job: image_scraper.download_image(session, *job),
+                                           downloads, image_scraper.max_concurrent):
+                    pass
 
     # Generate final report
-    report = "Combined Scraping Report\n=====================\n\n"
-    report += f"Domain: {domain}\n"
-    report += f"Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+    report_parts = [
+        "Combined Scraping Report\n=====================\n\n",
+        f"Domain: {domain}\n",
+        f"Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n",
+    ]
 
     if text_scraper:
-        report += "Text Content Summary:\n------------------\n"
-        report += f"Pages processed: {len(text_scraper.pages_data)}\n"
-        report += f"Output directory: {os.path.abspath(text_scraper.html_dir)}\n\n"
+        report_parts.append("Text Content Summary:\n------------------\n")
+        report_parts.append(f"Pages processed: {len(text_scraper.pages_data)}\n")
+        report_parts.append(f"Output directory: {os.path.abspath(text_scraper.html_dir)}\n\n")
 
     if image_scraper:
-        report += "Image Summary:\n-------------\n"
+        report_parts.append("Image Summary:\n-------------\n")
         total_images = sum(len(images) for images in image_scraper.images.values())
-        report += f"Total images found: {total_images}\n"
-        report += f"Output directory: {os.path.abspath(image_scraper.base_dir)}\n\n"
+        report_parts.append(f"Total images found: {total_images}\n")
+        report_parts.append(f"Output directory: {os.path.abspath(image_scraper.base_dir)}\n\n")
+    report = "".join(report_parts)
 
     # Save combined report
     report_path = os.path.join(base_dir, "sitefox_report.txt")
@@ -0,0 +1,6 @@
+"""
+SiteFox Common
+HTTP, parsing and rate limiting helpers shared by the SiteFox scrapers.
+"""
+
+__version__ = "1.0.0" 
\ No newline at end of file
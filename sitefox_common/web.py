@@ -0,0 +1,221 @@
+import asyncio
+import aiohttp
+import aiofiles
+import hashlib
+import os
+import secrets
+import sqlite3
+import time
+from aiohttp import ClientTimeout
+from bs4 import BeautifulSoup
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urldefrag, urljoin, urlparse
+
+# Size of each piece streamed from the network to disk
+DOWNLOAD_CHUNK_SIZE = 65536
+
+# Pages and downloads larger than these are skipped rather than read into
+# memory or onto disk; protects against huge sitemaps and mislabeled binaries
+MAX_PAGE_BYTES = 10 * 1024 * 1024
+MAX_DOWNLOAD_BYTES = 200 * 1024 * 1024
+
+# Content types parsed as pages
+HTML_CONTENT_TYPES = frozenset({"text/html", "application/xhtml+xml"})
+
+def netloc(url: str) -> str:
+    """Return the host part of a URL without a full urlparse for plain http(s) URLs."""
+    if url.startswith(("https://", "http://")):
+        host = url.split("/", 3)[2]
+        # A query or fragment right after the host needs the real parser
+        if "?" not in host and "#" not in host:
+            return host
+    return urlparse(url).netloc
+
+def normalize_url(url: str) -> str:
+    """Drop the fragment and give bare hosts a "/" path, so each page has one spelling."""
+    url = urldefrag(url).url
+    if not urlparse(url).path:
+        # Treat "https://site" and "https://site/" as the same page
+        url = urljoin(url, "/")
+    return url
+
+def extract_links(soup: BeautifulSoup, page_url: str) -> List[str]:
+    """Return the absolute URLs of the links on a parsed page."""
+    # Resolve against the page itself so relative links work on deeper
+    # pages, and drop fragments that point within a page
+    return [normalize_url(urljoin(page_url, link["href"])) for link in soup.find_all("a", href=True)]
+
+def claim_path(claimed: Dict[str, str], directory: str, filename: str, key: str) -> str:
+    """Return a path for key's file in directory, renaming it if another key already uses the name."""
+    filepath = os.path.join(directory, filename)
+    if claimed.setdefault(filepath, key) != key:
+        # Different files with one name (e.g. two uploads called photo.jpg)
+        # would otherwise overwrite each other
+        stem, ext = os.path.splitext(filename)
+        digest = hashlib.blake2b(key.encode(), digest_size=4).hexdigest()
+        filepath = os.path.join(directory, f"{stem}-{digest}{ext}")
+        claimed[filepath] = key
+    return filepath
+
+class RateLimiter:
+    """Token bucket rate limiter to control requests per second"""
+    def __init__(self, requests_per_second: float, capacity: float = 1.0):
+        self.requests_per_second = requests_per_second
+        self.capacity = capacity
+        self._tokens = capacity
+        # Monotonic so clock adjustments (NTP, DST) can't corrupt the bucket
+        self._last_refill = time.monotonic()
+        # Only held by a caller sleeping for a token; later callers queue behind it
+        self._lock = asyncio.Lock()
+
+    def _take_token(self) -> bool:
+        """Refill the bucket for the elapsed time and take a token if one is available."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._last_refill) * self.requests_per_second)
+        self._last_refill = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        """Wait for rate limit if necessary"""
+        # Fast path without the lock: the event loop runs one coroutine at a time
+        # and nothing here awaits, so the check and update can't interleave
+        if not self._lock.locked() and self._take_token():
+            return
+
+        async with self._lock:
+            while not self._take_token():
+                await asyncio.sleep((1 - self._tokens) / self.requests_per_second)
+
+class HTTPCache:
+    """ETag/Last-Modified store for conditional GETs, persisted in SQLite between runs"""
+    def __init__(self, path: str):
+        # Autocommit so each entry is saved as soon as it is stored
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, sha256 TEXT, body TEXT, path TEXT)"
+        )
+
+    def _lookup(self, url: str) -> Optional[Tuple]:
+        return self._db.execute(
+            "SELECT etag, last_modified, body, path FROM responses WHERE url = ?", (url,)
+        ).fetchone()
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        """Return validator headers for url, if a reusable copy of it was saved."""
+        row = self._lookup(url)
+        if not row:
+            return {}
+        etag, last_modified, body, path = row
+        # Without the saved body or file a 304 would leave nothing to work with
+        if body is None and not (path and os.path.exists(path)):
+            return {}
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def cached_text(self, url: str) -> Optional[str]:
+        """Return the saved body of a page."""
+        row = self._lookup(url)
+        return row[2] if row else None
+
+    def cached_path(self, url: str) -> Optional[str]:
+        """Return where a downloaded file was saved."""
+        row = self._lookup(url)
+        return row[3] if row else None
+
+    def _store(self, url: str, response: aiohttp.ClientResponse, sha256: str,
+               body: Optional[str] = None, path: Optional[str] = None):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return  # Nothing to revalidate with next time
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+            (url, etag, last_modified, sha256, body, path)
+        )
+
+    def store_text(self, url: str, response: aiohttp.ClientResponse, body: str):
+        """Remember a page's validators along with its body."""
+        self._store(url, response, hashlib.sha256(body.encode()).hexdigest(), body=body)
+
+    def store_file(self, url: str, response: aiohttp.ClientResponse, path: str, sha256: str):
+        """Remember a downloaded file's validators and where it was saved."""
+        self._store(url, response, sha256, path=path)
+
+    def close(self):
+        self._db.close()
+
+async def fetch_html(session: aiohttp.ClientSession, url: str, rate_limiter: RateLimiter,
+                     headers: Dict[str, str], http_cache: Optional[HTTPCache] = None) -> str:
+    """Fetch a page's HTML, reusing the cached copy if the server reports it unchanged."""
+    await rate_limiter.acquire()
+    timeout = ClientTimeout(total=30)
+    if http_cache:
+        headers = {**headers, **http_cache.conditional_headers(url)}
+    async with session.get(url, headers=headers, timeout=timeout) as response:
+        if response.status == 304 and http_cache:
+            return http_cache.cached_text(url)
+        response.raise_for_status()
+        if response.content_type not in HTML_CONTENT_TYPES:
+            raise ValueError(f"Skipped non-HTML response ({response.content_type})")
+        if response.content_length is not None and response.content_length > MAX_PAGE_BYTES:
+            raise ValueError(f"Skipped page larger than {MAX_PAGE_BYTES} bytes")
+
+        # Read with a running cap since many servers don't send Content-Length
+        chunks = []
+        size = 0
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_PAGE_BYTES:
+                raise ValueError(f"Skipped page larger than {MAX_PAGE_BYTES} bytes")
+            chunks.append(chunk)
+        content = b"".join(chunks).decode(response.charset or "utf-8", errors="replace")
+        if http_cache:
+            http_cache.store_text(url, response, content)
+        return content
+
+async def is_downloaded(session: aiohttp.ClientSession, url: str, filepath: str,
+                        rate_limiter: RateLimiter, headers: Dict[str, str]) -> bool:
+    """Check whether filepath already holds all of url, as saved by an earlier run."""
+    if not os.path.exists(filepath):
+        return False
+    # Ask with HEAD: skipping after a GET would leave the body unread and
+    # cost the pooled connection
+    await rate_limiter.acquire()
+    try:
+        async with session.head(url, headers=headers, timeout=ClientTimeout(total=30),
+                                allow_redirects=True) as response:
+            return response.status == 200 and response.content_length == os.path.getsize(filepath)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return False
+
+async def save_response(response: aiohttp.ClientResponse, filepath: str) -> Optional[str]:
+    """Stream a response body to filepath and return its SHA-256, or None if it is too large."""
+    # Write to a temporary name and move it into place once complete, so a
+    # partial file is never mistaken for a finished download
+    temp_path = f"{filepath}.{secrets.token_hex(4)}.part"
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(temp_path, "wb") as f:
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_DOWNLOAD_BYTES:
+                    break
+                digest.update(chunk)
+                await f.write(chunk)
+        if size > MAX_DOWNLOAD_BYTES:
+            return None
+        os.replace(temp_path, filepath)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return digest.hexdigest()
@@ -1,32 +1,67 @@
 import asyncio
 import aiohttp
+import hashlib
 import os
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
+from bs4 import BeautifulSoup, Tag
+from urllib.parse import parse_qsl, urlencode, urljoin, urlparse, urlunparse
 import re
-from typing import Set, List, Dict
-import time
+import secrets
+import shutil
+from typing import Set, List, Dict, Iterable, Iterator, Optional
 from aiohttp import ClientTimeout
 from pathlib import Path
 import mimetypes
+from sitefox_common.web import (MAX_DOWNLOAD_BYTES, HTTPCache, RateLimiter, claim_path, is_downloaded,
+                                netloc, save_response)
 
-class RateLimiter:
-    """Rate limiter to control requests per second"""
-    def __init__(self, requests_per_second: float):
-        self.rate = 1.0 / requests_per_second
-        self.last_request = 0
-        self._lock = asyncio.Lock()
-    
-    async def acquire(self):
-        """Wait for rate limit if necessary"""
-        async with self._lock:
-            now = time.time()
-            if now - self.last_request < self.rate:
-                await asyncio.sleep(self.rate - (now - self.last_request))
-            self.last_request = time.time()
+# Query parameters that change which image is served (resizing, cropping);
+# all others, such as cache busters, are ignored when spotting duplicates
+CONTENT_QUERY_PARAMS = frozenset({"w", "h", "resize", "fit", "crop", "quality"})
+
+# Responses meaning a full-size original doesn't exist. Other client errors,
+# such as 429 or 401, say nothing about the file and are reported instead.
+MISSING_STATUSES = frozenset({403, 404, 410})
+
+# WordPress appends the scaled dimensions to resized images, e.g. photo-300x200.jpg
+_WP_SCALED_RE = re.compile(r'-\d+x\d+\.(jpg|jpeg|png|gif)$', re.IGNORECASE)
+# Links to these files are assets, not pages
+_ASSET_RE = re.compile(r"\.(jpg|jpeg|png|gif|pdf|css|js)$", re.IGNORECASE)
+
+# Non-content tags whose images are skipped
+SKIPPED_TAGS = frozenset({"header", "footer", "nav", "aside"})
+
+def _find_content_images(tag: Tag) -> Iterator[Tag]:
+    """Yield img tags below tag in document order, skipping page chrome and sidebars."""
+    # An explicit stack rather than recursion, since malformed pages with
+    # many unclosed tags nest deeper than Python's recursion limit
+    stack = [iter(tag.children)]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+        elif isinstance(child, Tag) and child.name not in SKIPPED_TAGS and "sidebar" not in child.get("class", ()):
+            if child.name == "img":
+                yield child
+            stack.append(iter(child.children))
+
+def extract_image_urls(soup: BeautifulSoup, page_url: str) -> List[str]:
+    """Return the absolute URLs of the content images on a parsed page."""
+    image_urls = []
+    # Find all images in content with a single pass over the body,
+    # skipping header, footer, nav and sidebar subtrees
+    for img in _find_content_images(soup.body or soup):
+        src = img.get("src", "")
+        if src:
+            # Resolve against the page so relative paths on deeper pages work
+            image_urls.append(urljoin(page_url, src))
+    return image_urls
 
 class WordPressImageScraper:
-    def __init__(self, domain: str, max_concurrent: int = 5, requests_per_second: float = 2.0):
+    def __init__(self, domain: str, max_concurrent: int = 5, requests_per_second: float = 2.0,
+                 headers: Optional[Dict[str, str]] = None,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 content_query_params: Iterable[str] = CONTENT_QUERY_PARAMS,
+                 http_cache: Optional[HTTPCache] = None):
         # Clean up domain input - handle https:// properly
         if domain.startswith("https://") or domain.startswith("http://"):
             self.base_url = domain
@@ -35,15 +70,24 @@ class WordPressImageScraper:
         else:
             self.domain = domain
             self.base_url = f"https://{domain}"
+        # Cached for is_valid_url, which runs once per link and image
+        self._base_netloc = urlparse(self.base_url).netloc
         
-        self.headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        }
+        # Extra per-request headers; common ones are set on the shared session
+        self.headers = headers or {}
         self.pages: Dict[str, str] = {}  # URL to page name mapping
         self.images: Dict[str, Set[str]] = {}  # Page name to image URLs mapping
+        self.fallback_urls: Dict[str, str] = {}  # Full-size URL to scaled URL mapping
+        self.content_query_params = frozenset(content_query_params)
+        # Canonical URL to the path of its first download, so images shared by
+        # several pages are only fetched once
+        self._downloaded: Dict[str, asyncio.Future] = {}
         self.errors: List[str] = []
         self.max_concurrent = max_concurrent
-        self.rate_limiter = RateLimiter(requests_per_second)
+        # A limiter can be shared so several scrapers stay within one budget
+        self.rate_limiter = rate_limiter or RateLimiter(requests_per_second)
+        # Optional conditional-GET cache used to skip unchanged responses on re-crawls
+        self.http_cache = http_cache
         
         # Create directory structure
         # Get the script directory
@@ -55,138 +99,186 @@ class WordPressImageScraper:
         # Create domain-specific directories
         self.base_dir = os.path.join(self.downloads_dir, self.domain)
         os.makedirs(self.base_dir, exist_ok=True)
+        # Page directories already created, so each costs one mkdir per run
+        self._dirs_created: Set[str] = set()
+        # Output path to the canonical URL saved there, so different images
+        # with the same name don't overwrite each other
+        self._claimed_paths: Dict[str, str] = {}
 
     def is_valid_url(self, url: str) -> bool:
         """Check if the URL belongs to the base domain."""
-        parsed_base = urlparse(self.base_url)
-        parsed_url = urlparse(url)
-        return parsed_url.netloc == parsed_base.netloc
+        return netloc(url) == self._base_netloc
 
     def get_page_name(self, url: str) -> str:
         """Generate a clean page name from URL."""
         path = urlparse(url).path.strip("/")
         return path if path else "home"
 
+    def canonicalize_url(self, url: str) -> str:
+        """Normalize an image URL so copies of the same file compare equal."""
+        parsed = urlparse(url)
+        query = urlencode(sorted((key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+                                 if key in self.content_query_params))
+        return urlunparse((parsed.scheme, parsed.netloc.lower(), parsed.path, "", query, ""))
+
     def get_full_size_url(self, url: str) -> str:
         """Convert WordPress scaled image URL to full size URL."""
-        # Pattern to match WordPress scaled image dimensions
-        pattern = r'-\d+x\d+\.(jpg|jpeg|png|gif)$'
-        
         # Try to remove dimensions from filename
-        base_url = re.sub(pattern, r'.\1', url)
+        base_url = _WP_SCALED_RE.sub(r'.\1', url)
         return base_url
 
-    async def check_image_exists(self, session: aiohttp.ClientSession, url: str) -> bool:
-        """Check if an image URL is accessible."""
-        try:
-            async with session.head(url, headers=self.headers, timeout=ClientTimeout(total=10)) as response:
-                return response.status == 200
-        except:
-            return False
+    def filter_links(self, links: Iterable[str]) -> Set[str]:
+        """Return the internal pages among links."""
+        return {full_url for full_url in links
+                if self.is_valid_url(full_url) and not _ASSET_RE.search(full_url)}
 
-    async def get_linked_pages(self, session: aiohttp.ClientSession, url: str) -> Set[str]:
-        """Scan the website and return a set of internal linked pages."""
-        try:
-            await self.rate_limiter.acquire()
-            timeout = ClientTimeout(total=30)
-            async with session.get(url, headers=self.headers, timeout=timeout) as response:
-                response.raise_for_status()
-                content = await response.text()
-                soup = BeautifulSoup(content, "html.parser")
-                
-                pages = set()
-                for link in soup.find_all("a", href=True):
-                    href = link["href"]
-                    full_url = urljoin(self.base_url, href)
-                    if self.is_valid_url(full_url) and not re.search(r"\.(jpg|jpeg|png|gif|pdf|css|js)$", full_url, re.IGNORECASE):
-                        pages.add(full_url)
-                return pages
-        except Exception as e:
-            self.errors.append(f"Error fetching {url}: {e}")
-            return set()
+    def add_page_images(self, url: str, image_urls: Iterable[str]):
+        """Record the images found on a page, preferring full-size originals."""
+        # Get page name for directory
+        page_name = self.get_page_name(url)
+        self.pages[url] = page_name
+        self.images[page_name] = set()
 
-    async def find_images_on_page(self, session: aiohttp.ClientSession, url: str):
-        """Find and process images on a page."""
-        try:
-            await self.rate_limiter.acquire()
-            timeout = ClientTimeout(total=30)
-            async with session.get(url, headers=self.headers, timeout=timeout) as response:
-                response.raise_for_status()
-                content = await response.text()
-                soup = BeautifulSoup(content, "html.parser")
-
-                # Remove header, footer, nav, and other non-content elements
-                for tag in soup.find_all(["header", "footer", "nav", "aside", ".sidebar"]):
-                    tag.decompose()
-
-                # Get page name for directory
-                page_name = self.get_page_name(url)
-                self.pages[url] = page_name
-                self.images[page_name] = set()
-
-                # Find all images in content
-                for img in soup.find_all("img"):
-                    src = img.get("src", "")
-                    if not src:
-                        continue
-
-                    # Convert to absolute URL
-                    img_url = urljoin(self.base_url, src)
-                    if not self.is_valid_url(img_url):
-                        continue
-
-                    # Check if it's a WordPress scaled image
-                    if re.search(r'-\d+x\d+\.(jpg|jpeg|png|gif)$', img_url, re.IGNORECASE):
-                        full_size_url = self.get_full_size_url(img_url)
-                        # Check if full-size image exists
-                        if await self.check_image_exists(session, full_size_url):
-                            self.images[page_name].add(full_size_url)
-                        else:
-                            self.images[page_name].add(img_url)
-                    else:
-                        self.images[page_name].add(img_url)
-
-                print(f"Found {len(self.images[page_name])} images on {url}")
+        for img_url in image_urls:
+            if not self.is_valid_url(img_url):
+                continue
 
-        except Exception as e:
-            self.errors.append(f"Error processing images on {url}: {e}")
+            # Prefer the full-size version of WordPress scaled images.
+            # Whether it exists is only learned when downloading, which
+            # falls back to the scaled URL if the original is missing.
+            if _WP_SCALED_RE.search(img_url):
+                full_size_url = self.get_full_size_url(img_url)
+                self.fallback_urls[full_size_url] = img_url
+                self.images[page_name].add(full_size_url)
+            else:
+                self.images[page_name].add(img_url)
 
-    async def download_image(self, session: aiohttp.ClientSession, url: str, page_name: str):
-        """Download an image and save it to the appropriate directory."""
+        print(f"Found {len(self.images[page_name])} images on {url}")
+
+    async def download_image(self, session: aiohttp.ClientSession, url: str, page_name: str) -> Optional[str]:
+        """Download an image into the page's directory and return its path."""
+        key = self.canonicalize_url(url)
+        if key in self._downloaded:
+            # Already fetched for another page, so reuse that copy
+            existing = await self._downloaded[key]
+            if not existing:
+                return None
+            print(f"Linked: {os.path.basename(existing)}")
+            return self._link_image(existing, page_name, key)
+
+        # Register before fetching so concurrent requests for the same image wait on this one
+        future = asyncio.get_running_loop().create_future()
+        self._downloaded[key] = future
+        filepath = None
+        try:
+            filepath = await self._fetch_image(session, url, page_name)
+        finally:
+            future.set_result(filepath)
+        return filepath
+
+    async def _fetch_image(self, session: aiohttp.ClientSession, url: str, page_name: str) -> Optional[str]:
+        """Fetch an image, falling back to the scaled copy if the full size is missing."""
         try:
+            key = self.canonicalize_url(url)
+            conditional = self.http_cache.conditional_headers(url) if self.http_cache else {}
+            # Skip files already saved completely by an earlier run; with
+            # validators the conditional GET below already covers this
+            filepath = self._image_path(url, page_name)
+            if (not conditional and filepath
+                    and await is_downloaded(session, url, filepath, self.rate_limiter, self.headers)):
+                print(f"Already downloaded: {os.path.basename(filepath)}")
+                return filepath
+
             await self.rate_limiter.acquire()
             timeout = ClientTimeout(total=60)
-            async with session.get(url, headers=self.headers, timeout=timeout) as response:
-                response.raise_for_status()
-                content = await response.read()
-
-                # Create directory for page if it doesn't exist
-                page_dir = os.path.join(self.base_dir, page_name)
-                os.makedirs(page_dir, exist_ok=True)
-
-                # Generate filename from URL
-                filename = os.path.basename(urlparse(url).path)
-                if not filename:
-                    # Generate filename from URL hash if no filename in URL
-                    ext = mimetypes.guess_extension(response.headers.get("content-type", ""))
-                    filename = f"image_{hash(url)}{ext if ext else '.jpg'}"
-
-                filepath = os.path.join(page_dir, filename)
-                
-                # Save image
-                with open(filepath, 'wb') as f:
-                    f.write(content)
-                print(f"Downloaded: {filename}")
-                return filename
+            async with session.get(url, headers={**self.headers, **conditional}, timeout=timeout) as response:
+                if response.status == 304 and self.http_cache:
+                    existing = self.http_cache.cached_path(url)
+                    print(f"Not modified: {os.path.basename(existing)}")
+                    return self._link_image(existing, page_name, key)
+                missing_full_size = response.status in MISSING_STATUSES and url in self.fallback_urls
+                if not missing_full_size:
+                    response.raise_for_status()
+                    return await self._save_image(response, url, page_name)
+
+            # The full-size original doesn't exist, so download the scaled image
+            # instead, and list it in its place on every page that shows it
+            fallback_url = self.fallback_urls[url]
+            for image_urls in self.images.values():
+                if url in image_urls:
+                    image_urls.discard(url)
+                    image_urls.add(fallback_url)
+            return await self.download_image(session, fallback_url, page_name)
         except Exception as e:
             self.errors.append(f"Error downloading image {url}: {e}")
             return None
 
+    def _page_dir(self, page_name: str) -> str:
+        """Return the directory for a page's images, creating it on first use."""
+        page_dir = os.path.join(self.base_dir, page_name)
+        if page_dir not in self._dirs_created:
+            os.makedirs(page_dir, exist_ok=True)
+            self._dirs_created.add(page_dir)
+        return page_dir
+
+    def _image_path(self, url: str, page_name: str, content_type: Optional[str] = None) -> Optional[str]:
+        """Return where an image is saved, or None while its name depends on the unseen response."""
+        filename = os.path.basename(urlparse(url).path)
+        if not filename:
+            if content_type is None:
+                return None
+            # Generate filename from URL hash if no filename in URL. The builtin
+            # hash() is randomized per process, so use a stable digest instead
+            # to keep names the same on every run.
+            ext = mimetypes.guess_extension(content_type)
+            digest = hashlib.blake2b(url.encode(), digest_size=8).hexdigest()
+            filename = f"image_{digest}{ext if ext else '.jpg'}"
+        return claim_path(self._claimed_paths, self._page_dir(page_name), filename, self.canonicalize_url(url))
+
+    def _link_image(self, existing: str, page_name: str, key: str) -> str:
+        """Place an already downloaded image in a page's directory."""
+        filepath = claim_path(self._claimed_paths, self._page_dir(page_name), os.path.basename(existing), key)
+        # A fresh download replaces the original file rather than writing into
+        # it, so a link from an earlier run can point at stale bytes
+        if os.path.exists(filepath) and os.path.samefile(filepath, existing):
+            return filepath
+
+        # Build the copy under a temporary name and move it into place, so the
+        # page never shows a missing or half-copied image
+        temp_path = f"{filepath}.{secrets.token_hex(4)}.part"
+        try:
+            try:
+                os.link(existing, temp_path)
+            except OSError:
+                # Hard links aren't available everywhere (e.g. FAT drives, some Windows setups)
+                shutil.copy2(existing, temp_path)
+            os.replace(temp_path, filepath)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return filepath
+
+    async def _save_image(self, response: aiohttp.ClientResponse, url: str, page_name: str) -> str:
+        """Write a downloaded image to the page's directory and return its path."""
+        filepath = self._image_path(url, page_name, response.content_type)
+
+        if response.content_length is not None and response.content_length > MAX_DOWNLOAD_BYTES:
+            raise ValueError(f"Skipped image larger than {MAX_DOWNLOAD_BYTES} bytes")
+
+        # Stream image to disk without holding it in memory
+        sha256 = await save_response(response, filepath)
+        if sha256 is None:
+            raise ValueError(f"Skipped image larger than {MAX_DOWNLOAD_BYTES} bytes")
+        if self.http_cache:
+            self.http_cache.store_file(url, response, filepath, sha256)
+        print(f"Downloaded: {os.path.basename(filepath)}")
+        return filepath
+
     def generate_report(self) -> str:
         """Generate a summary report of the image scraping process."""
         total_images = sum(len(images) for images in self.images.values())
         
-        report = f"""
+        parts: List[str] = [f"""
 Image Scraping Report for {self.domain}
 =====================================
 Summary:
@@ -197,17 +289,17 @@ Summary:
 
 Images by page:
 -------------
-"""
+"""]
         for page_name, images in self.images.items():
-            report += f"\n{page_name} ({len(images)} images):\n"
+            parts.append(f"\n{page_name} ({len(images)} images):\n")
             for img_url in images:
-                report += f"  ✓ {img_url}\n"
+                parts.append(f"  ✓ {img_url}\n")
 
         if self.errors:
-            report += "\nErrors encountered:\n------------------\n"
+            parts.append("\nErrors encountered:\n------------------\n")
             for error in self.errors:
-                report += f"! {error}\n"
+                parts.append(f"! {error}\n")
         else:
-            report += "\nNo errors encountered during scraping.\n"
+            parts.append("\nNo errors encountered during scraping.\n")
 
-        return report 
\ No newline at end of file
+        return "".join(parts) 
\ No newline at end of file
@@ -1,33 +1,133 @@
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
+from bs4 import BeautifulSoup, CData, NavigableString, PageElement, Tag
+from urllib.parse import urlparse
 import re
 import os
 from datetime import datetime
-from typing import Dict, List, Set, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 import asyncio
 import aiohttp
-import time
+import aiofiles
+import hashlib
 from aiohttp import ClientTimeout
 from pathlib import Path
+from sitefox_common.web import (MAX_DOWNLOAD_BYTES, HTTPCache, RateLimiter, claim_path, is_downloaded,
+                                netloc, save_response)
 
-class RateLimiter:
-    """Rate limiter to control requests per second"""
-    def __init__(self, requests_per_second: float):
-        self.rate = 1.0 / requests_per_second
-        self.last_request = 0
-        self._lock = asyncio.Lock()
-    
-    async def acquire(self):
-        """Wait for rate limit if necessary"""
-        async with self._lock:
-            now = time.time()
-            if now - self.last_request < self.rate:
-                await asyncio.sleep(self.rate - (now - self.last_request))
-            self.last_request = time.time()
+# Maximum number of output files written at the same time
+MAX_OPEN_FILES = 32
+
+# Links to these files are assets, not pages
+_ASSET_RE = re.compile(r"\.(png|jpg|jpeg|gif|css|js)$", re.IGNORECASE)
+
+# Tags scraped as page content, and non-content tags whose subtrees are skipped
+CONTENT_TAGS = frozenset({"h1", "h2", "h3", "h4", "h5", "h6", "p", "ul", "ol"})
+SKIPPED_TAGS = frozenset({"header", "footer", "nav", "script", "style"})
+
+# String nodes counted as text, as get_text does; comments and the like are left out
+_TEXT_TYPES = (NavigableString, CData)
+
+# Invariant boilerplate around every generated page; only the title varies
+_HTML_PREFIX = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{title}</title>
+    <style>
+        body {{ font-family: Arial, sans-serif; line-height: 1.6; max-width: 800px; margin: 0 auto; padding: 20px; }}
+        h1, h2, h3, h4, h5, h6 {{ color: #333; }}
+        p {{ margin-bottom: 1em; }}
+        ul, ol {{ margin-bottom: 1em; }}
+    </style>
+</head>
+<body>
+    <h1>{title}</h1>
+"""
+_HTML_SUFFIX = "</body>\n</html>"
+
+def _render_html_list(element: Dict) -> str:
+    items = "".join(f"    <li>{item}</li>\n" for item in element["items"])
+    return f"<{element['style']}>\n{items}</{element['style']}>\n"
+
+# Renderers for each content element type
+_HTML_RENDERERS = {
+    "heading": lambda element: f"<h{element['level']}>{element['content']}</h{element['level']}>\n",
+    "text": lambda element: f"<p>{element['content']}</p>\n",
+    "list": _render_html_list,
+}
+_MARKDOWN_RENDERERS = {
+    "heading": lambda element: f"{'#' * element['level']} {element['content']}\n\n",
+    "text": lambda element: f"{element['content']}\n\n",
+    "list": lambda element: "".join(f"- {item}\n" for item in element["items"]) + "\n",
+}
+
+def _walk(tag: Tag) -> Iterator[PageElement]:
+    """Yield the nodes below tag in document order, skipping page chrome."""
+    # An explicit stack rather than recursion, since malformed pages with
+    # many unclosed tags nest deeper than Python's recursion limit
+    stack = [iter(tag.children)]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+        elif not isinstance(child, Tag):
+            yield child
+        elif child.name not in SKIPPED_TAGS:
+            yield child
+            stack.append(iter(child.children))
+
+def _find_content_tags(tag: Tag) -> Iterator[Tag]:
+    """Yield content tags below tag in document order, skipping page chrome."""
+    return (child for child in _walk(tag) if isinstance(child, Tag) and child.name in CONTENT_TAGS)
+
+def _get_text(tag: Tag) -> str:
+    """Return the stripped text of tag like get_text(strip=True), leaving out page chrome inside it."""
+    return "".join(text for text in (str(node).strip() for node in _walk(tag) if type(node) in _TEXT_TYPES)
+                   if text)
+
+def extract_content(soup: BeautifulSoup, url: str) -> Tuple[str, List[Dict]]:
+    """Return the title and content elements of a parsed page."""
+    # Try to find the page title, as a plain str so the parse tree can be freed
+    if soup.title and soup.title.string:
+        title = str(soup.title.string)
+    else:
+        title = urlparse(url).path.strip("/").replace("/", "-") or "home"
+
+    # Extract content in a single pass over the body, skipping header,
+    # footer, nav, and other non-content subtrees instead of removing them,
+    # including when they sit inside a content tag
+    elements = []
+    for tag in _find_content_tags(soup.body or soup):
+        if tag.name.startswith('h'):
+            elements.append({
+                "type": "heading",
+                "level": int(tag.name[1]),
+                "content": _get_text(tag)
+            })
+        elif tag.name == "p":
+            text = _get_text(tag)
+            if text:  # Only add non-empty paragraphs
+                elements.append({
+                    "type": "text",
+                    "content": text
+                })
+        elif tag.name in ["ul", "ol"]:
+            items = [_get_text(li) for li in _walk(tag) if isinstance(li, Tag) and li.name == "li"]
+            if items:  # Only add non-empty lists
+                elements.append({
+                    "type": "list",
+                    "style": tag.name,
+                    "items": items
+                })
+
+    return title, elements
 
 class WebsiteScraper:
-    def __init__(self, domain: str, max_concurrent: int = 5, requests_per_second: float = 2.0):
+    def __init__(self, domain: str, max_concurrent: int = 5, requests_per_second: float = 2.0,
+                 headers: Optional[Dict[str, str]] = None,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 http_cache: Optional[HTTPCache] = None):
         # Clean up domain input - handle https:// properly
         if domain.startswith("https://") or domain.startswith("http://"):
             self.base_url = domain
@@ -36,15 +136,21 @@ class WebsiteScraper:
         else:
             self.domain = domain
             self.base_url = f"https://{domain}"
+        # Cached for is_valid_url, which runs once per link
+        self._base_netloc = urlparse(self.base_url).netloc
         
-        self.headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        }
+        # Extra per-request headers; common ones are set on the shared session
+        self.headers = headers or {}
         self.pages_data: Dict[str, Dict] = {}
         self.pdf_urls: Set[str] = set()
+        # Output path to the URL saved there, so PDFs with the same name don't collide
+        self._claimed_paths: Dict[str, str] = {}
         self.errors: List[str] = []
         self.max_concurrent = max_concurrent
-        self.rate_limiter = RateLimiter(requests_per_second)
+        # A limiter can be shared so several scrapers stay within one budget
+        self.rate_limiter = rate_limiter or RateLimiter(requests_per_second)
+        # Optional conditional-GET cache used to skip unchanged responses on re-crawls
+        self.http_cache = http_cache
         
         # Create directory structure
         # Get the script directory
@@ -62,173 +168,98 @@ class WebsiteScraper:
 
     def is_valid_url(self, url: str) -> bool:
         """Check if the URL belongs to the base domain."""
-        parsed_base = urlparse(self.base_url)
-        parsed_url = urlparse(url)
-        return parsed_url.netloc == parsed_base.netloc
+        return netloc(url) == self._base_netloc
 
     def is_pdf_url(self, url: str) -> bool:
         """Check if the URL points to a PDF file."""
         return url.lower().endswith('.pdf')
 
-    async def get_linked_pages(self, session: aiohttp.ClientSession, url: str) -> Set[str]:
-        """Scan the website and return a set of internal linked pages."""
-        try:
-            await self.rate_limiter.acquire()
-            timeout = ClientTimeout(total=30)
-            async with session.get(url, headers=self.headers, timeout=timeout) as response:
-                response.raise_for_status()
-                content = await response.text()
-                soup = BeautifulSoup(content, "html.parser")
-                
-                pages = set()
-                for link in soup.find_all("a", href=True):
-                    href = link["href"]
-                    full_url = urljoin(self.base_url, href)
-                    if self.is_valid_url(full_url):
-                        if self.is_pdf_url(full_url):
-                            self.pdf_urls.add(full_url)
-                        elif not re.search(r"\.(png|jpg|jpeg|gif|css|js)$", full_url, re.IGNORECASE):
-                            pages.add(full_url)
-                return pages
-        except Exception as e:
-            self.errors.append(f"Error fetching {url}: {e}")
-            return set()
+    def filter_links(self, links: Iterable[str]) -> Set[str]:
+        """Return the internal pages among links, recording any PDFs found."""
+        pages = set()
+        for full_url in links:
+            if self.is_valid_url(full_url):
+                if self.is_pdf_url(full_url):
+                    self.pdf_urls.add(full_url)
+                elif not _ASSET_RE.search(full_url):
+                    pages.add(full_url)
+        return pages
 
     async def download_pdf(self, session: aiohttp.ClientSession, url: str):
         """Download a PDF file from the given URL."""
         try:
+            # Generate filename from URL
+            filename = os.path.basename(urlparse(url).path)
+            if not filename.lower().endswith('.pdf'):
+                filename += '.pdf'
+
+            filepath = claim_path(self._claimed_paths, self.pdf_dir, filename, url)
+            filename = os.path.basename(filepath)
+
+            conditional = self.http_cache.conditional_headers(url) if self.http_cache else {}
+            # Skip files already saved completely by an earlier run; with
+            # validators the conditional GET below already covers this
+            if not conditional and await is_downloaded(session, url, filepath, self.rate_limiter, self.headers):
+                print(f"Already downloaded PDF: {filename}")
+                return filename
+
             await self.rate_limiter.acquire()
             timeout = ClientTimeout(total=60)  # Longer timeout for PDF downloads
-            async with session.get(url, headers=self.headers, timeout=timeout) as response:
+            async with session.get(url, headers={**self.headers, **conditional}, timeout=timeout) as response:
+                if response.status == 304 and self.http_cache:
+                    filepath = self.http_cache.cached_path(url)
+                    print(f"Not modified PDF: {os.path.basename(filepath)}")
+                    return os.path.basename(filepath)
                 response.raise_for_status()
-                content = await response.read()
-                
-                # Generate filename from URL
-                filename = os.path.basename(urlparse(url).path)
-                if not filename.lower().endswith('.pdf'):
-                    filename += '.pdf'
-                
-                filepath = os.path.join(self.pdf_dir, filename)
-                
-                # Save PDF file
-                with open(filepath, 'wb') as f:
-                    f.write(content)
+
+                if response.content_length is not None and response.content_length > MAX_DOWNLOAD_BYTES:
+                    raise ValueError(f"Skipped PDF larger than {MAX_DOWNLOAD_BYTES} bytes")
+
+                # Stream PDF file to disk without holding it in memory
+                sha256 = await save_response(response, filepath)
+                if sha256 is None:
+                    raise ValueError(f"Skipped PDF larger than {MAX_DOWNLOAD_BYTES} bytes")
+                if self.http_cache:
+                    self.http_cache.store_file(url, response, filepath, sha256)
                 print(f"Downloaded PDF: {filename}")
                 return filename
         except Exception as e:
             self.errors.append(f"Error downloading PDF {url}: {e}")
             return None
 
-    async def scrape_page_content(self, session: aiohttp.ClientSession, url: str) -> Tuple[str, List[Dict]]:
-        """Scrape text content from a page, excluding header/footer."""
-        try:
-            await self.rate_limiter.acquire()
-            timeout = ClientTimeout(total=30)
-            async with session.get(url, headers=self.headers, timeout=timeout) as response:
-                response.raise_for_status()
-                content = await response.text()
-                soup = BeautifulSoup(content, "html.parser")
-
-                # Try to find the page title
-                title = soup.title.string if soup.title else urlparse(url).path.strip("/").replace("/", "-") or "home"
-
-                # Remove header, footer, nav, and other non-content elements
-                for tag in soup.find_all(["header", "footer", "nav", "script", "style"]):
-                    tag.decompose()
-
-                # Extract content
-                elements = []
-                for tag in soup.find_all(["h1", "h2", "h3", "h4", "h5", "h6", "p", "ul", "ol"]):
-                    if tag.name.startswith('h'):
-                        elements.append({
-                            "type": "heading",
-                            "level": int(tag.name[1]),
-                            "content": tag.get_text(strip=True)
-                        })
-                    elif tag.name == "p":
-                        text = tag.get_text(strip=True)
-                        if text:  # Only add non-empty paragraphs
-                            elements.append({
-                                "type": "text",
-                                "content": text
-                            })
-                    elif tag.name in ["ul", "ol"]:
-                        items = [li.get_text(strip=True) for li in tag.find_all("li")]
-                        if items:  # Only add non-empty lists
-                            elements.append({
-                                "type": "list",
-                                "style": tag.name,
-                                "items": items
-                            })
-                
-                return title, elements
-        except Exception as e:
-            self.errors.append(f"Error scraping {url}: {e}")
-            return "", []
-
     def generate_html_page(self, title: str, elements: List[Dict]) -> str:
         """Generate HTML content for a page."""
-        html = f"""<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{title}</title>
-    <style>
-        body {{ font-family: Arial, sans-serif; line-height: 1.6; max-width: 800px; margin: 0 auto; padding: 20px; }}
-        h1, h2, h3, h4, h5, h6 {{ color: #333; }}
-        p {{ margin-bottom: 1em; }}
-        ul, ol {{ margin-bottom: 1em; }}
-    </style>
-</head>
-<body>
-    <h1>{title}</h1>
-"""
-        for element in elements:
-            if element["type"] == "heading":
-                html += f"<h{element['level']}>{element['content']}</h{element['level']}>\n"
-            elif element["type"] == "text":
-                html += f"<p>{element['content']}</p>\n"
-            elif element["type"] == "list":
-                html += f"<{element['style']}>\n"
-                for item in element['items']:
-                    html += f"    <li>{item}</li>\n"
-                html += f"</{element['style']}>\n"
-        
-        html += "</body>\n</html>"
-        return html
+        return "".join([
+            _HTML_PREFIX.format_map({"title": title}),
+            *(_HTML_RENDERERS[element["type"]](element) for element in elements
+              if element["type"] in _HTML_RENDERERS),
+            _HTML_SUFFIX,
+        ])
 
     def generate_markdown(self) -> str:
         """Generate a single markdown document containing all pages."""
-        markdown = f"# {self.domain} Content\n\n"
-        markdown += "## Table of Contents\n\n"
+        # Collect pieces and join once; repeated += is quadratic on large sites
+        parts: List[str] = [f"# {self.domain} Content\n\n", "## Table of Contents\n\n"]
         
         # Add TOC
         for url, data in self.pages_data.items():
             page_name = data['title']
-            markdown += f"- [{page_name}](#{page_name.lower().replace(' ', '-')})\n"
+            parts.append(f"- [{page_name}](#{page_name.lower().replace(' ', '-')})\n")
         
-        markdown += "\n---\n\n"
+        parts.append("\n---\n\n")
         
         # Add content
         for url, data in self.pages_data.items():
-            markdown += f"# {data['title']}\n\n"
-            for element in data['elements']:
-                if element["type"] == "heading":
-                    markdown += f"{'#' * element['level']} {element['content']}\n\n"
-                elif element["type"] == "text":
-                    markdown += f"{element['content']}\n\n"
-                elif element["type"] == "list":
-                    for item in element['items']:
-                        markdown += f"- {item}\n"
-                    markdown += "\n"
-            markdown += "---\n\n"
+            parts.append(f"# {data['title']}\n\n")
+            parts.extend(_MARKDOWN_RENDERERS[element["type"]](element) for element in data['elements']
+                         if element["type"] in _MARKDOWN_RENDERERS)
+            parts.append("---\n\n")
         
-        return markdown
+        return "".join(parts)
 
     def generate_toc_html(self) -> str:
         """Generate table of contents HTML file."""
-        html = """<!DOCTYPE html>
+        parts: List[str] = ["""<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
@@ -238,46 +269,60 @@ class WebsiteScraper:
 <body>
     <h1>Table of Contents</h1>
     <ul>
-"""
+"""]
         for url, data in self.pages_data.items():
             page_filename = self.get_page_filename(url)
-            html += f'    <li><a href="{page_filename}">{data["title"]}</a></li>\n'
+            parts.append(f'    <li><a href="{page_filename}">{data["title"]}</a></li>\n')
         
-        html += """    </ul>
+        parts.append("""    </ul>
 </body>
-</html>"""
-        return html
+</html>""")
+        return "".join(parts)
 
     def get_page_filename(self, url: str) -> str:
         """Generate filename for a page based on its URL."""
-        path = urlparse(url).path.strip("/")
-        return f"{path or 'index'}.html"
+        parsed = urlparse(url)
+        name = parsed.path.strip("/") or "index"
+        if parsed.query:
+            # Pages like ?p=1 and ?p=2 share a path, so tell them apart with a
+            # stable digest of the query
+            name += "-" + hashlib.blake2b(parsed.query.encode(), digest_size=4).hexdigest()
+        return f"{name}.html"
 
     async def save_files(self):
         """Save all generated files."""
-        # Save individual HTML files
-        for url, data in self.pages_data.items():
-            filename = self.get_page_filename(url)
-            filepath = os.path.join(self.html_dir, filename)
-            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # Work out every path up front so each directory is created only once.
+        # URLs that still map to the same file (e.g. "/about" and "/about/")
+        # are written once, keeping the last page as a sequential loop would.
+        pages_by_path = {os.path.join(self.html_dir, self.get_page_filename(url)): data
+                         for url, data in self.pages_data.items()}
+        for directory in {os.path.dirname(filepath) for filepath in pages_by_path}:
+            os.makedirs(directory, exist_ok=True)
+
+        # Save individual HTML files concurrently, capping how many are open at once
+        semaphore = asyncio.Semaphore(MAX_OPEN_FILES)
+
+        async def write_page(filepath: str, data: Dict):
             html_content = self.generate_html_page(data["title"], data["elements"])
-            
-            with open(filepath, "w", encoding="utf-8") as f:
-                f.write(html_content)
+            async with semaphore:
+                async with aiofiles.open(filepath, "w", encoding="utf-8") as f:
+                    await f.write(html_content)
+
+        await asyncio.gather(*(write_page(filepath, data) for filepath, data in pages_by_path.items()))
 
         # Save TOC
         toc_path = os.path.join(self.html_dir, "toc.html")
-        with open(toc_path, "w", encoding="utf-8") as f:
-            f.write(self.generate_toc_html())
+        async with aiofiles.open(toc_path, "w", encoding="utf-8") as f:
+            await f.write(self.generate_toc_html())
 
         # Save markdown
         markdown_path = os.path.join(self.base_dir, f"{self.domain}_content.md")
-        with open(markdown_path, "w", encoding="utf-8") as f:
-            f.write(self.generate_markdown())
+        async with aiofiles.open(markdown_path, "w", encoding="utf-8") as f:
+            await f.write(self.generate_markdown())
 
     def generate_report(self) -> str:
         """Generate a summary report of the scraping process."""
-        report = f"""
+        parts: List[str] = [f"""
 Scraping Report for {self.domain}
 ================================
 Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
@@ -296,24 +341,24 @@ Summary:
 Configuration:
 -------------
 - Max concurrent requests: {self.max_concurrent}
-- Requests per second: {1.0 / self.rate_limiter.rate:.1f}
+- Requests per second: {self.rate_limiter.requests_per_second:.1f}
 
 Pages processed:
 --------------
-"""
+"""]
         for url in self.pages_data.keys():
-            report += f"✓ {url}\n"
+            parts.append(f"✓ {url}\n")
 
         if self.pdf_urls:
-            report += "\nPDFs downloaded:\n---------------\n"
+            parts.append("\nPDFs downloaded:\n---------------\n")
             for url in self.pdf_urls:
-                report += f"✓ {url}\n"
+                parts.append(f"✓ {url}\n")
 
         if self.errors:
-            report += "\nErrors encountered:\n------------------\n"
+            parts.append("\nErrors encountered:\n------------------\n")
             for error in self.errors:
-                report += f"! {error}\n"
+                parts.append(f"! {error}\n")
         else:
-            report += "\nNo errors encountered during scraping.\n"
+            parts.append("\nNo errors encountered during scraping.\n")
 
-        return report 
\ No newline at end of file
+        return "".join(parts) 
\ No newline at end of file